@@ -23,14 +23,56 @@
 
 '''A server that merely serves as-is documents'''
 
+import atexit
+import codecs
+import collections
 import contextlib
+import functools
+import hashlib
 import logging
 import os
 import re
+import shutil
 import socket
+import struct
+import tempfile
+import threading
+import time
+import traceback
+import zlib
 
 from bottle import Bottle, run, response, abort
 
+try:
+    # libdeflate is considerably faster than zlib for one-shot compression of
+    # in-memory buffers, which is exactly what we do with each document.
+    import deflate
+except ImportError:  # pragma: no cover
+    deflate = None
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+
+# The fixed header of a gzip member: magic, deflate method, no flags, no mtime
+_GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+# And its trailer: the CRC32 and length of the uncompressed data
+_GZIP_TRAILER = struct.Struct('<II').pack
+
+# A parsed document: its status, (key, value) pairs of headers and content. If
+# the content is to be served from a file instead, that file's name, the
+# offset of the content within it and its length.
+Document = collections.namedtuple(
+    'Document', ('status', 'headers', 'content', 'filename', 'offset', 'length'),
+    defaults=(None, 0, None))
+
 
 # Our logger
 logger = logging.getLogger('asis')
@@ -45,22 +87,35 @@ logger.setLevel(logging.WARNING)
 class Handler(object):
     '''Handle requests for asis documents.'''
 
-    # Regular expression for matching found headers
-    headerMatch = re.compile(r'([^:]+):([^\r]+)$')
+    # Regular expression for matching found headers, one per line
+    headerMatch = re.compile(r'^([^:\n]+):[ \t]*(.*)$', re.MULTILINE)
     supported_encodings = ('gzip', 'deflate')
+    # Brotli and Zstandard are supported when their modules are installed
+    if brotli is not None:  # pragma: no branch
+        supported_encodings += ('br',)
+    if zstandard is not None:  # pragma: no branch
+        supported_encodings += ('zstd',)
+    # Don't bother updating access times on documents, where supported
+    open_flags = os.O_RDONLY | getattr(os, 'O_NOATIME', 0)
+    # Where to look for the end of the headers before searching the rest
+    header_size = 8192
+    # Content larger than this is served from a file: the document itself if
+    # it's sent as-is, or a spooled copy if it's transformed
+    spool_size = 64 * 1024
 
     @staticmethod
     def compress(body, content_encoding):
         '''Compress the provided content subject to the content encoding'''
         if content_encoding == 'gzip':
-            import gzip
-            from io import StringIO
-            ios = StringIO()
-            fout = gzip.GzipFile(fileobj=ios, mode='wb')
-            fout.write(body)
-            fout.close()
-            return ios.getvalue()
-        elif content_encoding == 'deflate':  # pragma: no branch
+            if deflate is not None:
+                # libdeflate hands back a bytearray, which bottle won't serve
+                return bytes(deflate.gzip_compress(body, 6))
+            # A gzip member is just a raw deflate stream between a fixed
+            # header and a trailer of the CRC and length of the input
+            deflated = zlib.compress(body, 6)[2:-4]
+            trailer = _GZIP_TRAILER(zlib.crc32(body) & 0xffffffff, len(body) & 0xffffffff)
+            return _GZIP_HEADER + deflated + trailer
+        elif content_encoding == 'deflate':
             # This is a piece of code I find a little contentious. Apparently,
             # some browsers interpret `deflate` as a full zlib stream (with
             # header and checksum, and others interpret it merely as the
@@ -75,96 +130,261 @@ class Handler(object):
             # overflow discussion:
             #
             # http://stackoverflow.com/questions/1089662/python-inflate-and-deflate-implementations
-            import zlib
+            if deflate is not None:
+                return bytes(deflate.deflate_compress(body, 6))
             return zlib.compress(body)[2:-4]
+        elif content_encoding == 'br':
+            return brotli.compress(body, quality=4)
+        elif content_encoding == 'zstd':  # pragma: no branch
+            return zstandard.ZstdCompressor(level=3).compress(body)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=64)
+    def ascii_compatible(charset):
+        '''Whether or not ASCII text is encoded as itself in this charset'''
+        ascii = bytes(range(128))
+        try:
+            return ascii.decode('ascii').encode(charset) == ascii
+        except UnicodeError:
+            return False
+
+    @staticmethod
+    @functools.lru_cache(maxsize=64)
+    def is_utf8(charset):
+        '''Whether or not this charset is (an alias of) UTF-8'''
+        return codecs.lookup(charset).name == 'utf-8'
+
+    @classmethod
+    def open_file(cls, path):
+        '''Open a file descriptor for reading, so that it may be read without
+        the buffering of file objects'''
+        try:
+            return os.open(path, cls.open_flags)
+        except PermissionError:  # pragma: no cover
+            # O_NOATIME is only permitted for the owner of a file
+            return os.open(path, os.O_RDONLY)
+
+    @staticmethod
+    def read_fd(fd, size):
+        '''Read up to size bytes from the file descriptor, in a single read
+        where possible'''
+        raw = os.read(fd, size)
+        # A single read may come up short for very large files
+        while len(raw) < size:  # pragma: no cover
+            chunk = os.read(fd, size - len(raw))
+            if not chunk:
+                break
+            raw += chunk
+        return raw
 
     def __init__(self, path):
         self.path = path
+        # Documents' paths are built by concatenation with this prefix
+        self.prefix = os.path.join(path, '')
+        # Documents are static, so each one is only parsed, transcoded and
+        # compressed once. The modification time is part of the cache key,
+        # so a document that's edited gets picked up on the next request.
+        self.cache = functools.lru_cache(maxsize=1024)(self.parse)
+        self.spool_dir = None
+        # The name of the latest spool file of each document
+        self.spooled = {}
+        # Threaded servers may spool several documents at once
+        self.spool_lock = threading.Lock()
+
+    def spool(self, path, mtime, content):
+        '''Write the transformed content of the document at path to a file in
+        our spool directory, returning the name of that file, or None if it
+        couldn't be written'''
+        try:
+            with self.spool_lock:
+                if self.spool_dir is None:
+                    self.spool_dir = tempfile.mkdtemp(prefix='asis-')
+                    atexit.register(shutil.rmtree, self.spool_dir, True)
+
+            # Spool files are named for the version of the document they hold
+            name = os.path.join(self.spool_dir, '%s-%d' % (
+                hashlib.sha1(os.fsencode(path)).hexdigest(), mtime))
+            fd, tmp = tempfile.mkstemp(dir=self.spool_dir)
+            try:
+                with os.fdopen(fd, 'wb') as fout:
+                    fout.write(content)
+                os.replace(tmp, name)
+            except OSError:
+                os.remove(tmp)
+                raise
+        except OSError:
+            # The content can still be served from memory
+            logger.warning('Unable to spool %s', path, exc_info=True)
+            return None
+
+        # Only the latest version of each document is kept. Responses still
+        # reading a previous version keep it open regardless.
+        with self.spool_lock:
+            previous, self.spooled[path] = self.spooled.get(path), name
+        if previous is not None and previous != name:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(previous)
+        return name
+
+    def parse(self, path, mtime):
+        '''Reads the contents of a file, returning a `Document`'''
+        # Open the provided file, and read it
+        logger.debug('Opening %s...', path)
+
+        fd = self.open_file(path)
+        try:
+            return self.parse_fd(path, mtime, fd)
+        finally:
+            os.close(fd)
+
+    def parse_fd(self, path, mtime, fd):
+        '''Parse the file open as fd, as for `parse`'''
+        # Read file as binary.  Don't make assumptions about content encoding until we can be sure.
+        # Large files are only read as far as their headers to begin with,
+        # since their content may be served straight from the file.
+        logger.debug('    Reading...')
+        size = os.fstat(fd).st_size
+        raw = self.read_fd(fd, size if size <= self.spool_size else self.header_size)
+
+        # Find the empty line, which corresponds to the end of our headers.
+        # Only the header section gets split into lines; the content is
+        # kept as a single slice of what was read.
+        logger.debug('    Finding end of headers...')
+        end = raw.find(b'\n\n', 0, self.header_size)
+        if end < 0:
+            # Headers are typically small, but they aren't limited in size
+            raw += self.read_fd(fd, size - len(raw))
+            end = raw.find(b'\n\n', self.header_size - 1)
+        if end >= 0:
+            head, start = raw[:end], end + 2
+        elif raw[-1:] == b'\n':
+            # The empty line may also be the last line of the file
+            head, start = raw[:-1], len(raw)
+        else:
+            head, start = raw, None
+
+        # First, the status line. The leading protocol is dropped before it's
+        # decoded, without an intermediate string.
+        logger.debug('    Reading status line...')
+        status_line, _, head = head.partition(b'\n')
+        if status_line.startswith(b'HTTP'):
+            status_line = status_line[status_line.find(b' ') + 1:]
+
+        # ASSUMPTION. The HTTP Status line will be ascii.
+        status = status_line.decode('ascii')
+
+        # According to RFC 7230, only allow ASCII chars in headers.
+        # Anything requiring an advanced charset can do so via an
+        # escapement scheme. The use of which is beyond our use-case.
+        logger.debug('    Reading headers...')
+        headers = {}
+        for key, value in self.headerMatch.findall(head.decode('ascii')):
+            headers[key.lower()] = value
+
+        # record any directives specifically intended for asis file processing, and strip them
+        # out before sending.
+        directives = frozenset(d.strip().lower() for d in headers.pop('asis', '').split(';'))
+
+        # If all of the lines were headers, return an empty body.
+        if start is None:
+            return Document(status, tuple(headers.items()), b'')
+
+        # if no-charset is not set, it specifies that the file is encoded in UTF-8 and should
+        # be re-encoded per the charset stated in the content-type header.
+        charset = headers.get('content-type', '').partition('; charset=')[2]
+        if 'no-charset' in directives:
+            charset = ''
+
+        # If no-encoding is not set, it specifies that the file needs to be encoded in with
+        # the given encoder before sending.
+        encoding = headers.get('content-encoding', '')
+        if 'no-encoding' in directives:
+            encoding = ''
+        elif encoding and encoding not in self.supported_encodings:
+            logger.warning('Encoding %s not supported', encoding)
+            encoding = ''
+
+        length = size - start
+        if not (charset or encoding) and length > self.spool_size:
+            # Large content that's sent as-is is served straight from the file,
+            # rather than being held in memory, and never needs to be read.
+            content, filename, offset = None, path, start
+        else:
+            content = raw[start:] + self.read_fd(fd, size - len(raw))
+            filename, offset = None, 0
+            transformed = False
+            if charset and not self.is_utf8(charset):
+                # Content declared as UTF-8 is already in its charset. Pure
+                # ASCII content is unchanged by transcoding into most others,
+                # and checking for it is much cheaper than transcoding.
+                if not (self.ascii_compatible(charset) and content.isascii()):
+                    content = content.decode('utf-8').encode(charset)
+                    transformed = True
+
+            if encoding:
+                logger.debug('Encoding to %s', encoding)
+                content = self.compress(content, encoding)
+                transformed = True
+
+            length = len(content)
+            # Large transformed content is written to disk once, so that it may be
+            # sent with the server's wsgi.file_wrapper (and sendfile, if it can).
+            if transformed and length > self.spool_size:
+                filename = self.spool(path, mtime, content)
+                if filename is not None:
+                    content = None
+            elif length > self.spool_size:
+                # Transcoding turned out to be unnecessary
+                content, filename, offset = None, path, start
+
+        # Because we may have re-encoded and/or compressed the content, we
+        # should re-calculate the content-length if one had been otherwise
+        # specified.
+        if 'content-length' in headers:
+            headers['content-length'] = str(length)
+
+        logger.debug('    Headers: %s', headers)
+        return Document(status, tuple(headers.items()), content, filename, offset, length)
+
+    @staticmethod
+    def open_content(document):
+        '''The content of a document, or a file positioned at its start'''
+        if document.filename is None:
+            return document.content
+        # Bottle hands file objects to the server's wsgi.file_wrapper
+        fin = open(document.filename, 'rb')
+        fin.seek(document.offset)
+        return fin
 
     def read(self, path):
         '''Reads the contents of a file, manipulates the headers and responds
         with the content to send back'''
-        # Open the provided file, and read it
-        logger.debug('Opening %s...' % os.path.join(self.path, path))
-
-        # Read file as binary.  Don't make assumptions about content encoding until we can be sure.
-        with open(os.path.join(self.path, path), 'rb') as fin:
-            logger.debug('    Reading...')
-            lines = fin.read().split(b'\n')
-
-            # First, the status line
-            logger.debug('    Reading status line...')
-
-            # ASSUMPTION. The HTTP Status line will be ascii.
-            status_line = lines[0].decode('ascii')
-            if status_line.startswith('HTTP'):
-                response.status = status_line.partition(' ')[2]
-            else:
-                response.status = status_line
-
-            # According to RFC 7230, only allow ASCII chars in headers.
-            # Anything requiring an advanced charset can do so via an
-            # escapement scheme. The use of which is beyond our use-case.
-            logger.debug('    Reading headers...')
-
-            # Find the empty line, which corresponds to the end of our headers
-            try:
-                logger.debug('    Finding end of headers...')
-                index = lines.index(b'')
-            except ValueError:
-                index = len(lines)
-
-            # Ignore any pre-existing content-type header.
-            response.headers.pop('Content-Type', None)
-
-            # Now iterate over the lines before we hit the 'empty line' that ends the header section.
-            for line in lines[1:index]:
-                key, sep, value = line.partition(b': ')
-
-                # According to RFC 7230, only allow ASCII chars in headers.
-                # Anything requiring an advanced charset can do so via an
-                # escapement scheme. The use of which is beyond our use-case.
-                key = key.decode('ascii').lower()
-                value = value.decode('ascii')
-
-                response.headers[key] = value
-
-            # record any directives specifically intended for asis file processing before sending.
-            directives = [d.strip().lower() for d in response.headers.get('asis', '').split(';')]
-
-            # If all of the lines were headers, return an empty body.
-            if index == len(lines):
-                return b''
-
-            # Otherwise, the content is the rest of the file.
-            content = b'\n'.join(lines[(index + 1):])
-
-            charset = response.headers.get('content-type', '').partition('; charset=')[2]
-            if charset and ('no-charset' not in directives):
-                # if no-charset is not set, it specifies that the file is encoded in UTF-8 and should
-                # be re-encoded per the charset stated in the content-type header.
-                content = content.decode('utf-8').encode(charset)
-
-            encoding = response.headers.get('content-encoding', '')
-            if encoding and ('no-encoding' not in directives):
-                # If no-encoding is not set, it specifies that the file needs to be encoded in with
-                # the given encoder before sending.
-
-                if encoding in self.supported_encodings:
-                    logger.debug('Encoding to %s' % encoding)
-                    content = self.compress(content, encoding)
-                else:
-                    logger.warn('Encoding %s not supported' % encoding)
-
-            # Because we may have re-encoded and/or compressed the content, we
-            # should re-calculate the content-length if one had been otherwise
-            # specified.
-            if 'content-length' in response.headers:
-                response.headers['content-length'] = len(content)
-
-            logger.debug('    Headers: %s' % dict(response.headers))
-            logger.debug('    Returning content...')
-            return content
+        path = self.prefix + path.lstrip('/')
+        mtime = os.stat(path).st_mtime_ns
+        document = self.cache(path, mtime)
+        try:
+            content = self.open_content(document)
+        except FileNotFoundError:
+            if document.filename == path:
+                raise
+            # The spool file for this version was removed when another version
+            # was spooled, and this version has since been restored, mtime and
+            # all. Spool it once more.
+            document = self.parse(path, mtime)
+            content = self.open_content(document)
+
+        response.status = document.status
+        response_headers = response.headers
+        # Ignore any pre-existing content-type header.
+        response_headers.pop('Content-Type', None)
+        for key, value in document.headers:
+            response_headers[key] = value
+        # Bottle only works out the length of content it's given as bytes
+        if document.filename is not None and 'content-length' not in response_headers:
+            response_headers['Content-Length'] = str(document.length)
+
+        logger.debug('    Returning content...')
+        return content
 
     def handle(self, path):
         '''Handle a given request'''
@@ -173,10 +393,13 @@ class Handler(object):
             return self.read(path)
         except IOError:
             abort(404, 'File Not Found')
-        except:
+        except Exception as exc:
             logger.exception('Unexpected error')
-            import traceback
-            abort(500, traceback.format_exc())
+            # Formatting a traceback for the response is comparatively
+            # expensive, so it's only done when debugging
+            if logger.isEnabledFor(logging.DEBUG):
+                abort(500, traceback.format_exc())
+            abort(500, repr(exc))
 
 
 class Server(object):
@@ -187,19 +410,28 @@ class Server(object):
         self.port = port
         self.server = server
         self.app = Bottle()
-        self.app.route('/<path:path>')(Handler(path).handle)
+        self.handler = Handler(path)
+        self.app.route('/<path:path>')(self.handler.handle)
 
     def run(self):
         '''Start running the server'''
         run(self.app, host=self.host, port=self.port, server=self.server)
 
     def check_ready(self, timeout=0.01):
-        '''Wait until host is accepting connections on the provided port.'''
-        timeout = 0.01
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(timeout)
-        if sock.connect_ex((self.host, self.port)) == 0:
-            return True
+        '''Whether host is accepting connections on the provided port.'''
+        with contextlib.closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as sock:
+            sock.settimeout(timeout)
+            return sock.connect_ex((self.host, self.port)) == 0
+
+    def wait_ready(self, alive, delay=0.001, max_delay=0.05):
+        '''Wait until host is accepting connections on the provided port, for
+        as long as `alive()` holds. Returns whether or not it became ready.'''
+        # Back off between attempts rather than churning through sockets
+        while alive():
+            if self.check_ready():
+                return True
+            time.sleep(delay)
+            delay = min(delay * 2, max_delay)
         return False
 
     @contextlib.contextmanager
@@ -212,18 +444,22 @@ class Server(object):
             try:
                 self.run()
             finally:
+                # os._exit skips the atexit handler that removes the spool
+                if self.handler.spool_dir is not None:
+                    shutil.rmtree(self.handler.spool_dir, True)
                 os._exit(0)
         else:
-            # Wait for the child process to be ready and responding
-            while True:
+            def alive():
                 try:
                     os.kill(pid, 0)
                 except OSError:
-                    raise RuntimeError('Child process died.')
-                else:
-                    if self.check_ready():
-                        logger.info('Server started in %s', pid)
-                        break
+                    return False
+                return True
+
+            # Wait for the child process to be ready and responding
+            if not self.wait_ready(alive):
+                raise RuntimeError('Child process died.')
+            logger.info('Server started in %s', pid)
 
             try:
                 yield
@@ -249,9 +485,7 @@ class Server(object):
             # outcomes are possible -- an exception happens and the greenlet
             # terminates, or it starts the server and is listening on the
             # provided port.
-            while spawned:
-                if self.check_ready():
-                    break
+            self.wait_ready(lambda: bool(spawned))
 
             # If the greenlet had an exception, re-raise it in this context
             if not spawned:
@@ -39,9 +39,15 @@ setup(
     scripts          = [
         'bin/asis-server'
     ],
+    python_requires  = '>=3.7',
     install_requires = [
         'bottle'
     ],
+    extras_require   = {
+        'libdeflate': ['deflate'],
+        'brotli': ['brotli'],
+        'zstd': ['zstandard']
+    },
     classifiers      = [
         'Development Status :: 3 - Alpha',
         'Environment :: Console',
@@ -29,7 +29,14 @@ from gevent import monkey
 monkey.patch_all()
 
 import asis
+import contextlib
+import gzip
 import mock
+import os
+import shutil
+import tempfile
+import threading
+import zlib
 import logging
 import unittest
 import requests
@@ -52,6 +59,24 @@ class AsisTest(unittest.TestCase):
     def tearDownClass(cls):
         cls.context.__exit__(None, None, None)
 
+    @staticmethod
+    def body(path):
+        '''The content of the document at this path under test/'''
+        with open(os.path.join('test', path), 'rb') as fin:
+            return fin.read().partition(b'\n\n')[2]
+
+    def serve_from_files(self):
+        '''Serve all of the documents that are read from here on in this test
+        from files, as though they were large. Returns the server's handler.'''
+        handler = self.server.handler
+        # Documents already in the cache were parsed at their usual size
+        handler.cache.cache_clear()
+        self.addCleanup(handler.cache.cache_clear)
+        patcher = mock.patch.object(asis.Handler, 'spool_size', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return handler
+
     def test_basic(self):
         '''Works in the most basic way'''
         content = requests.get(self.base + 'basic/basic.asis').content
@@ -68,20 +93,53 @@ class AsisTest(unittest.TestCase):
         req = requests.get(self.base + 'basis/alksjdlfwoieuroaksjd;lfkjas')
         self.assertEqual(req.status_code, 404)
 
+    def test_prefix(self):
+        '''Document paths are relative to the handler's path.'''
+        self.assertEqual(asis.Handler('test').prefix, 'test/')
+        self.assertEqual(asis.Handler('test/').prefix, 'test/')
+        self.assertEqual(asis.Handler('').prefix, '')
+
     def test_empty(self):
         '''An empty document should fail gracefully'''
-        req = requests.get(self.base + 'basic/empty.asis')
+        with self.assertLogs(asis.logger, logging.ERROR) as logs:
+            req = requests.get(self.base + 'basic/empty.asis')
         self.assertEqual(req.status_code, 500)
         self.assertNotEqual(len(req.content), 0)
+        # The traceback is logged, even when it isn't sent
+        self.assertIsNotNone(logs.records[0].exc_info)
+
+    def test_empty_debug(self):
+        '''When debugging, errors respond with the traceback.'''
+        asis.logger.setLevel(logging.DEBUG)
+        self.addCleanup(asis.logger.setLevel, logging.WARNING)
+        req = requests.get(self.base + 'basic/empty.asis')
+        self.assertEqual(req.status_code, 500)
+        self.assertIn(b'Traceback', req.content)
 
     def test_headers_only(self):
         '''When there's only header content, we should succeed well'''
         req = requests.get(self.base + 'basic/only-headers.asis')
         self.assertEqual(len(req.content), 0)
 
+    def test_headers(self):
+        '''Headers are parsed with or without whitespace after the colon.'''
+        req = requests.get(self.base + 'basic/headers.asis')
+        self.assertEqual(req.headers['x-spaced'], 'spaced')
+        self.assertEqual(req.headers['x-tight'], 'tight')
+        self.assertEqual(req.content, b'Body\n')
+
+    def test_directives(self):
+        '''Asis directives are applied and stripped from the headers.'''
+        req = requests.get(self.base + 'basic/directives.asis', stream=True)
+        self.assertEqual(req.headers['content-encoding'], 'gzip')
+        self.assertNotIn('asis', req.headers)
+        # Neither compressed, nor transcoded from UTF-8
+        self.assertEqual(req.raw.read(), self.body('basic/directives.asis'))
+
     def test_compression(self):
         '''Gzip, deflate and zlib should work correctly.'''
         req = requests.get(self.base + 'encoding/gzip.asis')
+        self.assertEqual(req.status_code, 200)
         # Because the requests library automatically decompresses encoded
         # files, we'll make sure that its content-length and the content's
         # length don't match. And it should mention that it's gzip-compressed
@@ -90,6 +148,7 @@ class AsisTest(unittest.TestCase):
 
         # Same for deflate
         req = requests.get(self.base + 'encoding/deflate.asis')
+        self.assertEqual(req.status_code, 200)
         self.assertNotEqual(req.headers['content-length'], len(req.content))
         self.assertIn(b'Deflate', req.content)
 
@@ -98,6 +157,29 @@ class AsisTest(unittest.TestCase):
         req = requests.get(self.base + 'encoding/unsupported.asis')
         self.assertIn(b'Unsupported', req.content)
 
+    def test_compression_fallback(self):
+        '''Compression falls back to the standard library without libdeflate.'''
+        body = b'Hello world!' * 100
+        with mock.patch.object(asis, 'deflate', None):
+            gzipped = asis.Handler.compress(body, 'gzip')
+            deflated = asis.Handler.compress(body, 'deflate')
+        self.assertEqual(gzip.decompress(gzipped), body)
+        self.assertEqual(zlib.decompress(deflated, -zlib.MAX_WBITS), body)
+
+    @unittest.skipUnless(asis.brotli, 'brotli is not installed')
+    def test_compression_brotli(self):
+        '''Brotli compression works when brotli is installed.'''
+        body = b'Hello world!' * 100
+        compressed = asis.Handler.compress(body, 'br')
+        self.assertEqual(asis.brotli.decompress(compressed), body)
+
+    @unittest.skipUnless(asis.zstandard, 'zstandard is not installed')
+    def test_compression_zstd(self):
+        '''Zstandard compression works when zstandard is installed.'''
+        body = b'Hello world!' * 100
+        compressed = asis.Handler.compress(body, 'zstd')
+        self.assertEqual(asis.zstandard.ZstdDecompressor().decompress(compressed), body)
+
     def test_encoding(self):
         '''It should update the encodings provided correctly'''
         iso_encodings = [('iso-8859-%i' % num) for num in [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 13, 15, 16]]
@@ -113,6 +195,27 @@ class AsisTest(unittest.TestCase):
             # Also, none of these should parse when interpreted as UTF-8
             self.assertRaises(Exception, bytes.decode, req.content, 'utf-8')
 
+    def test_encoding_ascii(self):
+        '''Pure ASCII content is sent unchanged in an ASCII-compatible charset'''
+        req = requests.get(self.base + 'encoding/ascii.asis')
+        self.assertEqual(req.content, self.body('encoding/ascii.asis'))
+        self.assertEqual(int(req.headers['content-length']), len(req.content))
+
+    def test_ascii_compatible(self):
+        '''Identifies charsets in which ASCII text is left unchanged.'''
+        self.assertTrue(asis.Handler.ascii_compatible('iso-8859-1'))
+        self.assertTrue(asis.Handler.ascii_compatible('windows-1252'))
+        self.assertFalse(asis.Handler.ascii_compatible('utf-16'))
+        self.assertFalse(asis.Handler.ascii_compatible('cp500'))
+        self.assertFalse(asis.Handler.ascii_compatible('cp864'))
+
+    def test_is_utf8(self):
+        '''Identifies UTF-8 by any of its names.'''
+        self.assertTrue(asis.Handler.is_utf8('UTF-8'))
+        self.assertTrue(asis.Handler.is_utf8('utf8'))
+        self.assertTrue(asis.Handler.is_utf8('utf_8'))
+        self.assertFalse(asis.Handler.is_utf8('iso-8859-1'))
+
     def test_charset_no_length(self):
         '''When a charset is used, but a content-length is absent, none is provided.'''
         # Just exercise this branch
@@ -123,6 +226,142 @@ class AsisTest(unittest.TestCase):
         # Just exercise this branch
         requests.get(self.base + 'basic/encoding-no-length.asis')
 
+    def test_cache(self):
+        '''Documents are parsed once, and again when they're modified.'''
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'cached.asis')
+        with open(path, 'wb') as fout:
+            fout.write(b'HTTP/1.0 200 OK\n\nFirst')
+
+        handler = asis.Handler(tmpdir)
+        asis.response.bind()
+        self.assertEqual(handler.read('cached.asis'), b'First')
+        self.assertEqual(handler.read('cached.asis'), b'First')
+        self.assertEqual(handler.cache.cache_info().hits, 1)
+
+        with open(path, 'wb') as fout:
+            fout.write(b'HTTP/1.0 200 OK\n\nSecond')
+        os.utime(path, ns=(0, 0))
+        self.assertEqual(handler.read('cached.asis'), b'Second')
+
+        # A spooled document restored to an earlier version serves it again
+        def write(content, mtime):
+            with open(path, 'wb') as fout:
+                fout.write(b'HTTP/1.0 200 OK\nContent-Encoding: gzip\n\n' + content)
+            os.utime(path, ns=(mtime, mtime))
+
+        def read():
+            with handler.read('cached.asis') as fin:
+                return gzip.decompress(fin.read())
+
+        with mock.patch.object(asis.Handler, 'spool_size', 0):
+            write(b'First', 10 ** 9)
+            self.assertEqual(read(), b'First')
+            write(b'Second', 2 * 10 ** 9)
+            self.assertEqual(read(), b'Second')
+            write(b'First', 10 ** 9)
+            self.assertEqual(read(), b'First')
+        self.assertEqual(len(os.listdir(handler.spool_dir)), 1)
+
+    def test_large(self):
+        '''Large documents are sent with their length, even if none is given'''
+        req = requests.get(self.base + 'basic/large.asis')
+        self.assertEqual(req.status_code, 200)
+        self.assertEqual(req.content, self.body('basic/large.asis'))
+        self.assertNotIn('transfer-encoding', req.headers)
+        self.assertEqual(int(req.headers['content-length']), len(req.content))
+
+    def test_spooled_no_length(self):
+        '''Spooled documents are sent with their length, even if none is given'''
+        self.serve_from_files()
+        for path in ('basic/charset-no-length.asis', 'basic/encoding-no-length.asis'):
+            req = requests.get(self.base + path, stream=True)
+            self.assertEqual(req.status_code, 200)
+            self.assertNotIn('transfer-encoding', req.headers)
+            self.assertEqual(int(req.headers['content-length']), len(req.raw.read()))
+
+    def test_spool_documents(self):
+        '''Each spooled document gets its own file in the spool directory.'''
+        handler = self.serve_from_files()
+        gzipped = requests.get(self.base + 'encoding/gzip.asis')
+        latin = requests.get(self.base + 'encoding/iso-8859-1.asis')
+        self.assertIn(b'Gzip', gzipped.content)
+        self.assertIn(b'iso-8859-1', latin.content)
+        self.assertEqual(int(latin.headers['content-length']), len(latin.content))
+
+        spooled = [handler.spooled['test/encoding/%s.asis' % name]
+            for name in ('gzip', 'iso-8859-1')]
+        self.assertNotEqual(*spooled)
+        for name in spooled:
+            self.assertEqual(os.path.dirname(name), handler.spool_dir)
+            self.assertTrue(os.path.exists(name))
+
+    def test_removed_document(self):
+        '''A document removed before it can be opened responds with a 404'''
+        self.serve_from_files()
+        with mock.patch.object(asis.Handler, 'open_content', side_effect=FileNotFoundError):
+            req = requests.get(self.base + 'basic/basic.asis')
+        self.assertEqual(req.status_code, 404)
+
+    def test_spool_concurrently(self):
+        '''Documents spooled at the same time share a spool directory.'''
+        handler = asis.Handler('test')
+        barrier = threading.Barrier(4)
+        mkdtemp = tempfile.mkdtemp
+
+        def slow_mkdtemp(*args, **kwargs):
+            # Give each of the other threads the chance to get here too
+            with contextlib.suppress(threading.BrokenBarrierError):
+                barrier.wait(0.1)
+            return mkdtemp(*args, **kwargs)
+
+        def spool(index):
+            handler.spool('document-%i.asis' % index, 0, b'content')
+
+        threads = [threading.Thread(target=spool, args=(index,)) for index in range(4)]
+        with mock.patch('asis.tempfile.mkdtemp', side_effect=slow_mkdtemp) as patched:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(patched.call_count, 1)
+        self.assertEqual(len(os.listdir(handler.spool_dir)), 4)
+
+    def test_spool_failure(self):
+        '''Content that can't be spooled is served from memory instead.'''
+        handler = self.serve_from_files()
+        with mock.patch('asis.os.replace', side_effect=OSError('kaboom')):
+            req = requests.get(self.base + 'encoding/gzip.asis')
+        self.assertEqual(req.status_code, 200)
+        self.assertIn(b'Gzip', req.content)
+        # Nothing is left behind but the spooled documents themselves
+        self.assertEqual(
+            sorted(os.listdir(handler.spool_dir)),
+            sorted(os.path.basename(name) for name in handler.spooled.values()))
+
+    def test_spooled(self):
+        '''Large transformed documents are served from a spooled file.'''
+        self.serve_from_files()
+        req = requests.get(self.base + 'encoding/iso-8859-1.asis')
+        self.assertEqual(req.status_code, 200)
+        expected = self.body('encoding/iso-8859-1.asis').decode('utf-8').encode('iso-8859-1')
+        self.assertEqual(req.content, expected)
+        self.assertEqual(int(req.headers['content-length']), len(expected))
+
+    def test_served_from_file(self):
+        '''Large documents sent as-is are served straight from the file.'''
+        self.serve_from_files()
+        # Including those whose charset leaves them unchanged
+        paths = ('basic/basic.asis', 'basic/utf-8.asis', 'encoding/ascii.asis')
+        with mock.patch.object(asis.Handler, 'spool') as spool:
+            for path in paths:
+                req = requests.get(self.base + path)
+                self.assertEqual(req.status_code, 200)
+                self.assertEqual(req.content, self.body(path))
+                self.assertEqual(int(req.headers['content-length']), len(req.content))
+        spool.assert_not_called()
+
     def test_check_ready_true(self):
         '''Returns true if the server is ready.'''
         self.assertTrue(self.server.check_ready())